@@ -6,15 +6,44 @@ It takes a user request (e.g., 'all', 'all-major', 'native', or a specific list
 and filters them based on the capabilities of the `nvcc` compiler found on the system.
 """
 
+import sys
+
+# Return right away if only requesting native, before paying for the imports below
+if __name__ == "__main__" and len(sys.argv) == 2 and sys.argv[1].lower() == "native":
+    sys.stdout.write("native")
+    sys.exit(0)
+
 import argparse
+import ctypes
+import hashlib
+import json
 import logging
+import os
 import platform
 import re
 import shutil
 import subprocess
-import sys
+import tempfile
 from pathlib import Path
-from typing import NoReturn, Optional
+from typing import NamedTuple, NoReturn, Optional
+
+# Check before building debug-only strings, since f-strings evaluate even when not logged
+_DBG = logging.getLogger().isEnabledFor
+
+_ARCH_RE = re.compile(r"^\d+[a-z]?$")
+_ARCH_NUM_RE = re.compile(r"(\d+)")
+_ARCH_SUFFIX_RE = re.compile(r"[a-zA-Z]$")
+_SPLIT_RE = re.compile(r"[\s,]+")
+
+# Potential iGPU architectures (adjust if necessary for future hardware)
+_IGPU_ARCHS: frozenset[str] = frozenset(
+    {
+        "72",
+        "87",
+        "101",
+        "101a",
+    }
+)  # Xavier, Orin, Thor, DGX Spark (placeholders)
 
 
 def die(msg: str) -> NoReturn:
@@ -24,161 +53,287 @@ def die(msg: str) -> NoReturn:
 
 
 def get_nvcc_path() -> Path:
-    """Finds the nvcc executable in PATH or default location and returns its real Path object."""
+    """Finds the nvcc executable in PATH or default location and returns its Path object."""
     nvcc_path_str = shutil.which("nvcc")
-    nvcc_path = Path(nvcc_path_str) if nvcc_path_str else Path("/usr/local/cuda/bin/nvcc")
-    return nvcc_path.resolve()
+    if not nvcc_path_str:
+        return Path("/usr/local/cuda/bin/nvcc")
+    # Absolute so subprocess does not look up a relative PATH entry again
+    return Path(os.path.abspath(nvcc_path_str))
+
+
+def _arch_key(arch: str) -> int:
+    """Packs an architecture string into an int for sorting (numeric value, then suffix)."""
+    # sort by numeric value first (ex: 90, 100), suffix second (ex: 90, 90a)
+    num, i, length = 0, 0, len(arch)
+    while i < length and "0" <= arch[i] <= "9":
+        num = num * 10 + ord(arch[i]) - ord("0")
+        i += 1
+    suffix = ord(arch[i]) if i < length else 0
+    return (num << 8) | suffix
+
+
+def _query_nvrtc_archs(nvcc_path: Path) -> Optional[set[str]]:
+    """Queries the supported archs in-process from the NVRTC library next to nvcc.
+
+    Returns None if the library or its symbols are not available, or if the toolkit may support
+    arch-specific variants (ex: 90a, CUDA 12+) which NVRTC does not report.
+    """
+    # Resolve symlinks (ex: /usr/bin/nvcc) to find the toolkit nvcc belongs to
+    toolkit_dir = nvcc_path.resolve().parent.parent
+
+    # Check the toolkit version before loading the (large) library.
+    # version.json ships with CUDA 11.1+, and NVRTC can only list archs since CUDA 11.2.
+    try:
+        version = json.loads((toolkit_dir / "version.json").read_text())["cuda"]["version"]
+        toolkit_major = int(version.split(".")[0])
+    except (OSError, ValueError, TypeError, KeyError):
+        return None
+    if toolkit_major >= 12:
+        return None
 
+    nvrtc_path = toolkit_dir / "lib64" / "libnvrtc.so"
+    if not nvrtc_path.is_file():
+        return None
 
-def get_arch_sort_key(arch: str) -> tuple[int, str]:
-    """Extracts (numeric_value, full_string) for sorting architecture strings."""
-    match = re.match(r"\d+", arch)
-    if not match:
-        # only sort by string if no numeric match (unlikely)
-        return (0, arch)
+    try:
+        nvrtc = ctypes.CDLL(str(nvrtc_path))
+        nvrtc_version = nvrtc.nvrtcVersion
+        nvrtc_get_num_supported_archs = nvrtc.nvrtcGetNumSupportedArchs
+        nvrtc_get_supported_archs = nvrtc.nvrtcGetSupportedArchs
+    except (OSError, AttributeError) as e:
+        logging.debug(f"Could not query NVRTC ({nvrtc_path}): {e}")
+        return None
 
-    # sort by numeric value first (ex: 90, 100), full string second (ex: 90, 90a)
-    return (int(match.group()), arch)
+    major, minor = ctypes.c_int(), ctypes.c_int()
+    if nvrtc_version(ctypes.byref(major), ctypes.byref(minor)) != 0 or major.value >= 12:
+        return None
+
+    num_archs = ctypes.c_int()
+    if nvrtc_get_num_supported_archs(ctypes.byref(num_archs)) != 0 or num_archs.value <= 0:
+        return None
+    archs = (ctypes.c_int * num_archs.value)()
+    if nvrtc_get_supported_archs(archs) != 0:
+        return None
+
+    logging.debug(f"Queried supported archs from NVRTC {major.value}.{minor.value}: {nvrtc_path}")
+    return {str(arch) for arch in archs}
 
 
 def get_nvcc_archs(nvcc_path: Path) -> list[str]:
-    """Runs `nvcc -code-ls` and parses the output."""
-    cmd = [str(nvcc_path), "-code-ls"]
-    try:
-        result = subprocess.run(cmd, capture_output=True, text=True, check=True)
-    except FileNotFoundError:
-        die(f"nvcc command '{str(nvcc_path)}' not found or not executable.")
-    except subprocess.CalledProcessError as e:
-        die(f"Command '{' '.join(cmd)}' failed:\n{e.stderr}")
-
-    raw_archs: set[str] = set()
-    for line in result.stdout.strip().split("\n"):
-        line = line.strip()
-        if line.startswith("sm_"):
-            raw_archs.add(line[3:])
+    """Queries NVRTC or runs `nvcc -code-ls`, and parses the output."""
+    raw_archs = _query_nvrtc_archs(nvcc_path)
+    if raw_archs is None:
+        cmd = [str(nvcc_path), "-code-ls"]
+        try:
+            result = subprocess.run(cmd, capture_output=True, check=True)
+        except FileNotFoundError:
+            die(f"nvcc command '{str(nvcc_path)}' not found or not executable.")
+        except subprocess.CalledProcessError as e:
+            die(f"Command '{' '.join(cmd)}' failed:\n{e.stderr.decode(errors='replace')}")
+
+        # One arch per line: split on whitespace in a single pass over the raw bytes
+        raw_archs = {word[3:].decode() for word in result.stdout.split() if word.startswith(b"sm_")}
 
+    # Drop malformed entries (ex: bare "sm_") so parse_archs and the cache only see valid archs
+    raw_archs = {arch for arch in raw_archs if _ARCH_RE.match(arch)}
     if not raw_archs:
         die("Could not parse any architectures (sm_XX) from 'nvcc -code-ls' output.")
 
-    # Sort architectures numerically, then alphabetically (for suffixes)
-    sorted_archs = sorted(raw_archs, key=get_arch_sort_key)
-    logging.debug(f"nvcc supported archs: {', '.join(sorted_archs)}")
+    # Sort architectures numerically, then alphabetically (for suffixes).
+    # Invariant: this order is preserved by the filters, which only iterate in order and exclude,
+    # so generate_sass_ptx_arch_list does not need to sort again.
+    sorted_archs = sorted(raw_archs, key=_arch_key)
+    if _DBG(logging.DEBUG):
+        logging.debug(f"nvcc supported archs: {', '.join(sorted_archs)}")
     return sorted_archs
 
 
+def get_cache_dir() -> Optional[Path]:
+    """Returns the directory used to cache nvcc query results, or None if there is none."""
+    xdg_cache_home = os.environ.get("XDG_CACHE_HOME")
+    if xdg_cache_home:
+        return Path(xdg_cache_home) / "get_cmake_cuda_archs"
+    try:
+        return Path.home() / ".cache" / "get_cmake_cuda_archs"
+    except RuntimeError:
+        # No home directory (ex: HOME unset and uid not in passwd)
+        return None
+
+
+def _cached_nvcc_archs(nvcc_path: Path) -> list[str]:
+    """Returns `get_nvcc_archs` output, cached on disk and keyed by the nvcc binary identity."""
+    try:
+        stat = nvcc_path.stat()
+    except OSError:
+        # Let get_nvcc_archs report the missing binary
+        return get_nvcc_archs(nvcc_path)
+
+    cache_dir = get_cache_dir()
+    if cache_dir is None:
+        logging.debug("No cache directory available, not caching nvcc archs.")
+        return get_nvcc_archs(nvcc_path)
+
+    key_str = f"{nvcc_path.resolve()}:{stat.st_mtime_ns}:{stat.st_size}"
+    key = hashlib.sha256(key_str.encode()).hexdigest()
+    cache_file = cache_dir / f"{key}.json"
+
+    # Try to read from the cache
+    try:
+        archs = json.loads(cache_file.read_text())
+        if (
+            isinstance(archs, list)
+            and archs
+            and all(isinstance(arch, str) and _ARCH_RE.match(arch) for arch in archs)
+            # Must keep the sorted invariant of get_nvcc_archs
+            and archs == sorted(archs, key=_arch_key)
+        ):
+            if _DBG(logging.DEBUG):
+                logging.debug(f"nvcc supported archs (cached in {cache_file}): {', '.join(archs)}")
+            return archs
+        logging.debug(f"Ignoring invalid cache file: {cache_file}")
+    except (FileNotFoundError, json.JSONDecodeError, UnicodeDecodeError):
+        pass
+    except OSError as e:
+        logging.debug(f"Could not read cache file {cache_file}: {e}")
+
+    # Cache miss: query nvcc and store the result atomically
+    archs = get_nvcc_archs(nvcc_path)
+    try:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_file.parent, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(archs, f)
+            os.replace(tmp_path, cache_file)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError as e:
+        logging.debug(f"Could not write cache file {cache_file}: {e}")
+    return archs
+
+
 def parse_requested_archs(req_str: str) -> list[str]:
     """Parses comma or space separated architecture string into a list."""
     if not req_str:
         return []
-    archs = re.split(r"[\s,]+", req_str.strip())
+    archs = _SPLIT_RE.split(req_str.strip())
     filtered_archs = list(filter(None, archs))
     return filtered_archs
 
 
-def filter_archs_with_min_arch(archs: list[str], min_arch: Optional[int]) -> list[str]:
-    """Filters architecture list based on the minimum required major version."""
-    if min_arch is None or min_arch <= 0:
-        return list(archs)
-
-    filtered_list = [arch for arch in archs if int(re.match(r"(\d+)", arch).group(1)) >= min_arch]
-    logging.debug(f"Architectures >= sm_{min_arch}: {', '.join(filtered_list)}")
-    return filtered_list
-
-
-def filter_archs_for_platform(archs: list[str]) -> list[str]:
-    """Filters out architectures not suitable for the current platform (iGPUs on x86_64)."""
-    current_platform = platform.machine().lower()
-
-    if current_platform not in ["x86_64", "amd64"]:
-        return list(archs)  # Return a copy for consistency
-
-    # Potential iGPU architectures (adjust if necessary for future hardware)
-    igpu_archs: set[str] = {
-        "72",
-        "87",
-        "101",
-        "101a",
-    }  # Xavier, Orin, Thor, DGX Spark (placeholders)
+class ParsedArch(NamedTuple):
+    """Architecture string with its numeric value and whether it is specific (a, f suffixes)."""
 
-    # Log iGPU architectures to be removed
-    if removed_igpus := list(set(archs) & igpu_archs):
-        logging.debug(f"Removed iGPU archs from x86_64 build: {', '.join(removed_igpus)}")
+    arch: str
+    value: int
+    is_specific: bool
 
-    # Filter out iGPU architectures
-    filtered_list = [arch for arch in archs if arch not in igpu_archs]
-    logging.debug(f"Platform supported archs: {', '.join(filtered_list)}")
 
-    return filtered_list
+def parse_archs(archs: list[str]) -> list[ParsedArch]:
+    """Parses each architecture string once so that filters do not need to re-parse them."""
+    return [
+        ParsedArch(arch, int(_ARCH_NUM_RE.match(arch).group(1)), arch[-1].isalpha())
+        for arch in archs
+    ]
 
 
-def filter_major_archs(archs: list[str]) -> list[str]:
-    """Filters architecture list to include only major versions (ending in 0)."""
-    filtered_list = [arch for arch in archs if re.match(r"^\d+0$", arch)]
-    logging.debug(f"Major architectures only: {', '.join(filtered_list)}")
+def _apply_filters(
+    parsed_archs: list[ParsedArch],
+    min_arch: Optional[int],
+    is_x86: bool,
+    want_major_only: bool,
+) -> list[str]:
+    """Filters architectures in a single pass based on the minimum required major version,
+    the current platform (iGPUs on x86_64), and optionally major versions only (ending in 0).
+    """
+    # Preserves the sorted order of parsed_archs (see get_nvcc_archs)
+    check_min_arch = min_arch is not None and min_arch > 0
+
+    filtered_list: list[str] = []
+    for arch, value, is_specific in parsed_archs:
+        if check_min_arch and value < min_arch:
+            continue
+        if is_x86 and arch in _IGPU_ARCHS:
+            continue
+        if want_major_only and (is_specific or value % 10 != 0):
+            continue
+        filtered_list.append(arch)
+
+    if _DBG(logging.DEBUG):
+        removed_igpus = [
+            arch
+            for arch, value, _ in parsed_archs
+            if is_x86 and arch in _IGPU_ARCHS and not (check_min_arch and value < min_arch)
+        ]
+        if removed_igpus:
+            logging.debug(f"Removed iGPU archs from x86_64 build: {', '.join(removed_igpus)}")
+        filters = [f">= sm_{min_arch}"] if check_min_arch else []
+        filters += ["no iGPUs"] if is_x86 else []
+        filters += ["major only"] if want_major_only else []
+        logging.debug(
+            f"Architectures ({', '.join(filters) or 'unfiltered'}): {', '.join(filtered_list)}"
+        )
     return filtered_list
 
 
 def validate_user_archs(
     user_archs: list[str],
-    nvcc_supported_archs: list[str],
-    min_filtered_archs: list[str],
-    platform_filtered_archs: list[str],
+    nvcc_supported_set: frozenset[str],
+    min_filtered_set: frozenset[str],
+    platform_filtered_set: frozenset[str],
     min_arch_value: Optional[int],
 ) -> list[str]:
-    """Validates user-provided architectures against supported and filtered lists."""
+    """Validates user-provided architectures against supported and filtered sets."""
     if not user_archs:
         die("Requested architecture list is empty.")
 
-    nvcc_supported_set = set(nvcc_supported_archs)
-    min_filtered_set = set(min_filtered_archs)
-    platform_filtered_set = set(platform_filtered_archs)
-
-    final_valid_archs_str = ", ".join(platform_filtered_archs)
-    if not final_valid_archs_str:
-        final_valid_archs_str = "<None>"
+    def _valid() -> str:
+        # Only built when reporting an error
+        return ", ".join(sorted(platform_filtered_set, key=_arch_key)) or "<None>"
 
     validated_user_archs: list[str] = []
     for arch in user_archs:
         if arch not in nvcc_supported_set:
             die(
                 f"Requested architecture '{arch}' is not supported by this version of nvcc. "
-                f"Valid architectures: {final_valid_archs_str}"
+                f"Valid architectures: {_valid()}"
             )
         if arch not in min_filtered_set:
             die(
                 f"Requested architecture '{arch}' does not meet minimum requirement "
-                f"(sm_{min_arch_value}). Valid architectures: {final_valid_archs_str}"
+                f"(sm_{min_arch_value}). Valid architectures: {_valid()}"
             )
         if arch not in platform_filtered_set:
             die(
                 f"Requested architecture '{arch}' corresponds to an iGPU not supported "
-                f"on this platform (x86_64). Valid architectures: {final_valid_archs_str}"
+                f"on this platform (x86_64). Valid architectures: {_valid()}"
             )
         validated_user_archs.append(arch)
+
+    # Sort like get_nvcc_archs so that the output is sorted for all requests
+    validated_user_archs.sort(key=_arch_key)
     return validated_user_archs
 
 
 def generate_sass_ptx_arch_list(target_archs: list[str]) -> list[str]:
-    """Formats the final list with -real and -virtual suffixes for CMake."""
+    """Formats the final (already sorted) list with -real and -virtual suffixes for CMake."""
     if not target_archs:
         die("Cannot generate SASS/PTX list from empty target architectures.")
 
-    # Ensure architectures are sorted numerically, then alphabetically
-    sorted_archs = sorted(target_archs, key=get_arch_sort_key)
-
     # Find the highest non-specific (a, f suffixes) architecture
     ptx_target_base = ""
-    for arch in reversed(sorted_archs):
-        if not re.search(r"[a-zA-Z]$", arch):
+    for arch in reversed(target_archs):
+        if not _ARCH_SUFFIX_RE.search(arch):
             ptx_target_base = arch
             break
 
     # If no specific architecture found, use the highest available
     if not ptx_target_base:
-        ptx_target_base = sorted_archs[-1]
+        ptx_target_base = target_archs[-1]
 
     # Generate SASS and PTX targets
-    sass_targets = [f"{arch}-real" for arch in sorted_archs]
+    sass_targets = [f"{arch}-real" for arch in target_archs]
     ptx_target = f"{ptx_target_base}-virtual"
 
     final_archs = sass_targets + [ptx_target]
@@ -237,38 +392,43 @@ def main() -> None:
     # Get nvcc path
     nvcc_path: Optional[Path] = None
     if args.nvcc_path:
-        nvcc_path = Path(args.nvcc_path).resolve()
+        # Absolute so subprocess does not look up a bare relative path (ex: ./nvcc) in PATH
+        nvcc_path = Path(os.path.abspath(args.nvcc_path))
         logging.debug(f"Using user-provided nvcc path: {nvcc_path}")
+        if not os.access(nvcc_path, os.X_OK):
+            die(f"nvcc command '{nvcc_path}' not found or not executable.")
     else:
         logging.debug("No nvcc path provided, attempting automatic search...")
-        try:
-            nvcc_path = get_nvcc_path()
-            logging.debug(f"Using nvcc at: {nvcc_path}")
-        except FileNotFoundError:
+        nvcc_path = get_nvcc_path()
+        logging.debug(f"Using nvcc at: {nvcc_path}")
+        if not os.access(nvcc_path, os.X_OK):
             die(
                 "Could not find 'nvcc' automatically. Please provide path via --nvcc-path "
                 "or ensure it's in PATH or /usr/local/cuda/bin/nvcc."
             )
 
     # Get supported architectures
-    nvcc_supported_archs = get_nvcc_archs(nvcc_path)
-    min_filtered_archs = filter_archs_with_min_arch(nvcc_supported_archs, args.min_arch)
-    platform_filtered_archs = filter_archs_for_platform(min_filtered_archs)
+    nvcc_supported_archs = _cached_nvcc_archs(nvcc_path)
+    parsed_archs = parse_archs(nvcc_supported_archs)
+    is_x86 = platform.machine().lower() in ["x86_64", "amd64"]
 
     # Filter based on requested architectures
     target_archs: list[str] = []
     if req_lower == "all":
-        target_archs = platform_filtered_archs
-        logging.debug(f"Using platform supported cuda architectures: {', '.join(target_archs)}")
+        target_archs = _apply_filters(parsed_archs, args.min_arch, is_x86, False)
+        if _DBG(logging.DEBUG):
+            logging.debug(f"Using platform supported cuda architectures: {', '.join(target_archs)}")
     elif req_lower == "all-major":
-        target_archs = filter_major_archs(platform_filtered_archs)
+        target_archs = _apply_filters(parsed_archs, args.min_arch, is_x86, True)
     else:
+        min_filtered_archs = _apply_filters(parsed_archs, args.min_arch, False, False)
+        platform_filtered_archs = _apply_filters(parsed_archs, args.min_arch, is_x86, False)
         user_archs = parse_requested_archs(args.requested_archs)
         target_archs = validate_user_archs(
             user_archs,
-            nvcc_supported_archs,
-            min_filtered_archs,
-            platform_filtered_archs,
+            frozenset(nvcc_supported_archs),
+            frozenset(min_filtered_archs),
+            frozenset(platform_filtered_archs),
             args.min_arch,
         )
 